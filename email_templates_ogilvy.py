@@ -312,20 +312,55 @@ Unsubscribe: %unsubscribe_url%"""
 
 # ============== SEQUENCE SELECTOR ==============
 
+SEQUENCES = {
+    "core": CORE_SEQUENCE,
+    "running_ads": RUNNING_ADS_SEQUENCE,
+    "hiring": HIRING_SEQUENCE,
+    "high_reviews": HIGH_REVIEWS_SEQUENCE,
+}
+
 def get_sequence(signal: str = "core") -> dict:
     """Get email sequence based on signal"""
-    
-    sequences = {
-        "core": CORE_SEQUENCE,
-        "running_ads": RUNNING_ADS_SEQUENCE,
-        "hiring": HIRING_SEQUENCE,
-        "high_reviews": HIGH_REVIEWS_SEQUENCE,
-    }
-    
-    return sequences.get(signal, CORE_SEQUENCE)
+
+    return SEQUENCES.get(signal, CORE_SEQUENCE)
 
 def get_email(sequence: str, stage: str) -> dict:
     """Get specific email from sequence"""
-    
+
     seq = get_sequence(sequence)
     return seq.get(stage, seq["initial"])
+
+# ============== COMPILED TEMPLATES ==============
+
+# All placeholders used across the sequences, with render-time defaults
+_FIELD_DEFAULTS = "first_name='there', company_name='', google_review_count=''"
+
+def _compile_template(text: str):
+    """Compile a static {name}-only template into an f-string lambda"""
+
+    # Templates are module constants with plain {name} placeholders only,
+    # so the f-string form renders as bytecode-level string concat.
+    return eval("lambda " + _FIELD_DEFAULTS + ": f" + repr(text))
+
+def _compile_templates() -> dict:
+    """Build the per-(sequence, stage) cache of compiled renderers"""
+
+    compiled = {}
+    for seq_name, sequence in SEQUENCES.items():
+        compiled[seq_name] = {}
+        for stage, email in sequence.items():
+            compiled[seq_name][stage] = {
+                "subject": _compile_template(email["subject"]),
+                "body": _compile_template(email["body"]),
+            }
+    return compiled
+
+_COMPILED = _compile_templates()
+
+def render_email(sequence: str, stage: str, **ctx) -> tuple:
+    """Render (subject, body) from the compiled template cache"""
+
+    seq = _COMPILED.get(sequence, _COMPILED["core"])
+    tpl = seq.get(stage, seq["initial"])
+
+    return tpl["subject"](**ctx), tpl["body"](**ctx)
@@ -6,12 +6,21 @@ Sends follow-up emails to non-responders after 3 and 7 days
 import os
 import json
 import time
+import heapq
 import requests
-from datetime import datetime, timedelta
+from requests.adapters import HTTPAdapter
+from dataclasses import dataclass, asdict, fields
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
+from typing import Optional
+
+from email_templates_ogilvy import get_email, render_email
 
 # ============== CONFIG ==============
 
+# Invariant console banner, built once
+_BAR = "=" * 60
+
 MAILGUN_API_KEY = os.getenv("MAILGUN_API_KEY", "")
 MAILGUN_DOMAIN = os.getenv("MAILGUN_DOMAIN", "trustedpartnerhub.com")
 FROM_EMAIL = os.getenv("EMAIL_FROM_ADDRESS", "support@trustedpartnerhub.com")
@@ -20,183 +29,276 @@ FROM_NAME = os.getenv("EMAIL_FROM_NAME", "Lead Agents Studio")
 # Storage
 SENT_FILE = "/tmp/sent_las.json"
 FOLLOWUP_FILE = "/tmp/followup_tracking.json"
+FOLLOWUP_LOG = FOLLOWUP_FILE + ".jsonl"
 
-# ============== FOLLOW-UP TEMPLATES (OGILVY) ==============
-
-FOLLOWUP_1 = {
-    "subject": "following up - {company_name}",
-    "body": """Hi {first_name},
+# Rewrite the snapshot once the event log outgrows it by this factor
+COMPACT_RATIO = 10
 
-Following up with one simple idea:
+# Sends per second (token bucket, replaces the old 5s blocking sleep)
+SEND_RATE = 0.2
 
-Clinics don't lose money because ads "don't work."
-They lose money because:
-(1) creative gets stale, and
-(2) the first reply is slow.
+# Mailgun's recipient-variables cap per message
+BATCH_LIMIT = 1000
 
-Lead Agents Studio solves both:
-fresh AI video creatives on demand + instant follow‑up/booking on WhatsApp/SMS/phone.
+# Reuse one HTTPS connection to Mailgun instead of a TLS handshake per send
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
 
-If you're curious, the live demo takes about a minute:
-https://leadagentsstudio.com
-
-Want the WhatsApp demo or the quick call demo?
-
-—
-Lead Agents Studio
-support@leadagentsstudio.com
+# ============== FOLLOW-UP TEMPLATES (OGILVY) ==============
 
-Unsubscribe: %unsubscribe_url%""",
-    "days_after": 3,
-}
+# Single source of truth lives in email_templates_ogilvy (shared compiled cache)
+FOLLOWUP_1 = {**get_email("core", "followup_1"), "days_after": 3}
+FOLLOWUP_2 = {**get_email("core", "followup_2"), "days_after": 7}
 
-FOLLOWUP_2 = {
-    "subject": "last note - {company_name}",
-    "body": """Hi {first_name},
+# ============== STORAGE ==============
 
-Last note from me.
+@dataclass(slots=True)
+class Row:
+    """One lead's follow-up state; slot access beats repeated dict probes"""
+    company_name: str = ""
+    first_name: str = "there"
+    initial_sent: Optional[str] = None
+    initial_sent_epoch: Optional[float] = None
+    followup_1_sent: Optional[str] = None
+    followup_2_sent: Optional[str] = None
+    replied: bool = False
+    opened: bool = False
+    clicked: bool = False
+    current_stage: str = "initial"
 
-If "fresh creatives + instant follow‑up that books" is relevant for {company_name},
-here's the demo link:
-https://leadagentsstudio.com
+_ROW_FIELDS = {f.name for f in fields(Row)}
 
-If it's not a priority right now, no worries — I'll close the loop.
+def _row_from_dict(data: dict) -> Row:
+    """Build a Row from a snapshot dict, ignoring unknown keys"""
+    return Row(**{k: v for k, v in data.items() if k in _ROW_FIELDS})
 
-—
-Lead Agents Studio
-support@leadagentsstudio.com
+def _append_op(email: str, op: str, **extra):
+    """Append one state change to the event log (O(1) per lead)"""
+    entry = {"email": email.lower(), "op": op}
+    entry.update(extra)
+    with open(FOLLOWUP_LOG, 'a') as f:
+        f.write(json.dumps(entry) + "\n")
 
-Unsubscribe: %unsubscribe_url%""",
-    "days_after": 7,
-}
+def _apply_op(tracking: dict, entry: dict):
+    """Fold one logged op into the in-memory tracking dict"""
+    email = entry.get("email", "")
+    op = entry.get("op")
 
-# ============== STORAGE ==============
+    if op == "init":
+        tracking[email] = Row(
+            company_name=entry.get("company_name", ""),
+            first_name=entry.get("first_name", "there"),
+            initial_sent=entry.get("initial_sent"),
+            initial_sent_epoch=entry.get("initial_sent_epoch"),
+        )
+    elif email in tracking:
+        row = tracking[email]
+        if op in ("followup_1_sent", "followup_2_sent"):
+            setattr(row, op, entry.get("at"))
+            row.current_stage = "fu1" if op == "followup_1_sent" else "fu2"
+        elif op in ("replied", "opened", "clicked"):
+            setattr(row, op, True)
 
 def load_followup_tracking() -> dict:
-    """Load follow-up tracking data"""
+    """Load the last snapshot, then replay the event log on top"""
+    tracking = {}
     try:
         if Path(FOLLOWUP_FILE).exists():
             with open(FOLLOWUP_FILE) as f:
-                return json.load(f)
+                tracking = {email: _row_from_dict(d) for email, d in json.load(f).items()}
+    except:
+        pass
+
+    try:
+        if Path(FOLLOWUP_LOG).exists():
+            with open(FOLLOWUP_LOG) as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        _apply_op(tracking, json.loads(line))
+            _maybe_compact(tracking)
     except:
         pass
-    return {}
+
+    return tracking
 
 def save_followup_tracking(data: dict):
-    """Save follow-up tracking"""
-    with open(FOLLOWUP_FILE, 'w') as f:
-        json.dump(data, f, indent=2)
+    """Write a full snapshot (plain dicts on disk) and reset the event log"""
+    # Write-then-rename: a kill mid-write can't corrupt the snapshot and
+    # silently reset tracking (which would re-send the whole campaign)
+    tmp = FOLLOWUP_FILE + ".tmp"
+    with open(tmp, 'w') as f:
+        json.dump({email: asdict(row) for email, row in data.items()}, f, separators=(",", ":"))
+    os.replace(tmp, FOLLOWUP_FILE)
+    if Path(FOLLOWUP_LOG).exists():
+        open(FOLLOWUP_LOG, 'w').close()
+
+def _maybe_compact(tracking: dict):
+    """Rewrite the snapshot when the event log has outgrown it"""
+    try:
+        log_size = Path(FOLLOWUP_LOG).stat().st_size
+        snap_size = Path(FOLLOWUP_FILE).stat().st_size if Path(FOLLOWUP_FILE).exists() else 0
+        if log_size > COMPACT_RATIO * max(snap_size, 1):
+            save_followup_tracking(tracking)
+    except:
+        pass
 
 def track_initial_send(email: str, company: str):
-    """Track when initial email was sent"""
-    tracking = load_followup_tracking()
-    
-    tracking[email.lower()] = {
-        "company_name": company,
-        "first_name": "there",
-        "initial_sent": datetime.utcnow().isoformat(),
-        "followup_1_sent": None,
-        "followup_2_sent": None,
-        "replied": False,
-        "opened": False,
-        "clicked": False,
-    }
-    
-    save_followup_tracking(tracking)
+    """Track when initial email was sent (append-only, no full rewrite)"""
+    _append_op(
+        email,
+        "init",
+        company_name=company,
+        first_name="there",
+        initial_sent=datetime.utcnow().isoformat(),
+        initial_sent_epoch=time.time(),
+    )
 
 # ============== SENDING ==============
 
-def send_email(email: str, subject: str, body: str, tag: str) -> bool:
-    """Send via Mailgun"""
-    
+_next_send = 0.0
+
+def _acquire_send_slot():
+    """Token bucket: pace sends to SEND_RATE, never idle on skipped rows"""
+    global _next_send
+    now = time.time()
+    wait = _next_send - now
+    if wait > 0:
+        time.sleep(wait)
+        now = _next_send
+    _next_send = now + 1.0 / SEND_RATE
+
+def send_batch(recipients: dict, subject: str, body: str, tag: str) -> bool:
+    """One Mailgun POST for up to 1000 recipients via recipient-variables"""
+
     try:
-        response = requests.post(
+        response = _SESSION.post(
             f"https://api.mailgun.net/v3/{MAILGUN_DOMAIN}/messages",
             auth=("api", MAILGUN_API_KEY),
             data={
                 "from": f"{FROM_NAME} <{FROM_EMAIL}>",
-                "to": email,
+                "to": list(recipients),
                 "subject": subject,
                 "text": body,
+                "recipient-variables": json.dumps(recipients),
                 "o:tracking": "yes",
                 "o:tracking-clicks": "yes",
                 "o:tracking-opens": "yes",
                 "o:tag": ["lead-agents-studio", "medspa", tag],
             },
-            timeout=30,
+            timeout=60,
         )
-        
+
         return response.status_code == 200
-    
+
     except:
         return False
 
 # ============== FOLLOW-UP LOGIC ==============
 
+def _initial_epoch(row: Row) -> float:
+    """Epoch of the initial send (stored field, ISO fallback for old rows)"""
+    if row.initial_sent_epoch is not None:
+        return row.initial_sent_epoch
+    return datetime.fromisoformat(row.initial_sent).replace(tzinfo=timezone.utc).timestamp()
+
+def _days_since_initial(row: Row, now_epoch: float) -> int:
+    """Days since the initial send"""
+    return int((now_epoch - _initial_epoch(row)) // 86400)
+
+def _build_due_heap(tracking: dict) -> list:
+    """Min-heap of (due_epoch, email, stage) for leads still in play"""
+    heap = []
+    for email, row in tracking.items():
+        if row.replied or row.clicked:
+            continue
+        epoch = _initial_epoch(row)
+        if not row.followup_1_sent:
+            heap.append((epoch + FOLLOWUP_1["days_after"] * 86400, email, "fu1"))
+        elif not row.followup_2_sent:
+            heap.append((epoch + FOLLOWUP_2["days_after"] * 86400, email, "fu2"))
+    heapq.heapify(heap)
+    return heap
+
 def send_followups():
     """Check and send follow-ups"""
     
-    print(f"\n{'='*60}")
+    print(f"\n{_BAR}")
     print(f"FOLLOW-UP SYSTEM")
     print(f"Time: {datetime.utcnow().isoformat()}")
-    print(f"{'='*60}\n")
+    print(f"{_BAR}\n")
     
     tracking = load_followup_tracking()
     now = datetime.utcnow()
-    
-    sent_followup_1 = 0
-    sent_followup_2 = 0
-    
-    for email, data in tracking.items():
-        # Skip if replied/clicked
-        if data.get("replied") or data.get("clicked"):
+    now_epoch = time.time()
+
+    sent = {"fu1": 0, "fu2": 0}
+
+    # Pop exactly the due leads; everything later stays untouched
+    heap = _build_due_heap(tracking)
+    due = {"fu1": [], "fu2": []}
+
+    while heap and heap[0][0] <= now_epoch:
+        _due, email, stage = heapq.heappop(heap)
+        row = tracking[email]
+
+        # May have replied/clicked after the heap was built
+        if row.replied or row.clicked:
             continue
-        
-        initial_sent = datetime.fromisoformat(data["initial_sent"])
-        days_since = (now - initial_sent).days
-        
-        company = data.get("company_name", "your clinic")
-        first_name = data.get("first_name", "there")
-        
-        # Follow-up 1 (Day 3)
-        if days_since >= 3 and not data.get("followup_1_sent"):
-            print(f"📧 Follow-up 1: {email} ({company}) - Day {days_since}")
-            
-            subject = FOLLOWUP_1["subject"].format(company_name=company)
-            body = FOLLOWUP_1["body"].format(first_name=first_name, company_name=company)
-            
-            if send_email(email, subject, body, "followup-1"):
-                data["followup_1_sent"] = now.isoformat()
-                sent_followup_1 += 1
-                print(f"   ✅ Sent")
-            else:
-                print(f"   ❌ Failed")
-        
-        # Follow-up 2 (Day 7)
-        elif days_since >= 7 and not data.get("followup_2_sent"):
-            print(f"📧 Follow-up 2: {email} ({company}) - Day {days_since}")
-            
-            subject = FOLLOWUP_2["subject"].format(company_name=company)
-            body = FOLLOWUP_2["body"].format(first_name=first_name, company_name=company)
-            
-            if send_email(email, subject, body, "followup-2"):
-                data["followup_2_sent"] = now.isoformat()
-                sent_followup_2 += 1
+        if stage == "fu2" and not row.followup_1_sent:
+            continue
+
+        due[stage].append(email)
+
+    # One POST per template per 1000 recipients; Mailgun substitutes
+    # %recipient.*% server-side from recipient-variables
+    for stage, template_stage, op, tag in (
+        ("fu1", "followup_1", "followup_1_sent", "followup-1"),
+        ("fu2", "followup_2", "followup_2_sent", "followup-2"),
+    ):
+        if not due[stage]:
+            continue
+
+        subject, body = render_email(
+            "core", template_stage,
+            first_name="%recipient.first_name%",
+            company_name="%recipient.company_name%",
+        )
+
+        for i in range(0, len(due[stage]), BATCH_LIMIT):
+            chunk = due[stage][i:i + BATCH_LIMIT]
+            recipients = {
+                email: {
+                    "first_name": tracking[email].first_name or "there",
+                    "company_name": tracking[email].company_name or "your clinic",
+                }
+                for email in chunk
+            }
+
+            print(f"📧 Follow-up batch ({tag}): {len(chunk)} recipients")
+
+            _acquire_send_slot()
+            if send_batch(recipients, subject, body, tag):
+                stamp = now.isoformat()
+                for email in chunk:
+                    row = tracking[email]
+                    setattr(row, op, stamp)
+                    row.current_stage = stage
+                    _append_op(email, op, at=stamp)
+                sent[stage] += len(chunk)
                 print(f"   ✅ Sent")
             else:
                 print(f"   ❌ Failed")
-        
-        time.sleep(5)  # Rate limiting
-    
+
     # Save updated tracking
     save_followup_tracking(tracking)
     
-    print(f"\n{'='*60}")
+    print(f"\n{_BAR}")
     print(f"SUMMARY")
-    print(f"{'='*60}")
-    print(f"Follow-up 1 sent: {sent_followup_1}")
-    print(f"Follow-up 2 sent: {sent_followup_2}")
-    print(f"{'='*60}\n")
+    print(f"{_BAR}")
+    print(f"Follow-up 1 sent: {sent['fu1']}")
+    print(f"Follow-up 2 sent: {sent['fu2']}")
+    print(f"{_BAR}\n")
 
 # ============== MAIN ==============
 
@@ -11,95 +11,132 @@ Runs daily to:
 """
 import os
 import json
-import requests
+import asyncio
+import ijson
+import orjson
+import hashlib
+import httpx
+from collections import Counter
 from datetime import datetime, timedelta
 from pathlib import Path
 
 # ============== CONFIG ==============
 
+# Invariant console banner, built once
+_BAR = "=" * 60
+
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
 OPENAI_MODEL = "gpt-4o-mini"
 
+# Keep only this many history entries on disk (the prompt uses the last 3)
+MAX_HISTORY = 50
+
 # Storage
 TRACKING_FILE = "/tmp/followup_tracking.json"
 EVENTS_FILE = "/tmp/events_las.json"
 INSIGHTS_FILE = "/tmp/llm_insights.json"
 VARIANTS_FILE = "/tmp/email_variants.json"
 
+OPENAI_URL = "https://api.openai.com/v1/chat/completions"
+
+def _openai_client() -> httpx.AsyncClient:
+    """One HTTP/2 connection shared by the OpenAI calls in a run"""
+    return httpx.AsyncClient(
+        http2=True,
+        timeout=60,
+        headers={
+            "Authorization": f"Bearer {OPENAI_API_KEY}",
+            "Content-Type": "application/json",
+        },
+    )
+
 # ============== DATA LOADING ==============
 
 def load_tracking() -> dict:
     """Load follow-up tracking data"""
     try:
         if Path(TRACKING_FILE).exists():
-            with open(TRACKING_FILE) as f:
-                return json.load(f)
+            return orjson.loads(Path(TRACKING_FILE).read_bytes())
     except:
         pass
     return {}
 
-def load_events() -> list:
-    """Load email events"""
+def iter_events():
+    """Stream email events one at a time (the archive can grow to MBs)"""
     try:
         if Path(EVENTS_FILE).exists():
-            with open(EVENTS_FILE) as f:
-                return json.load(f)
+            with open(EVENTS_FILE, 'rb') as f:
+                yield from ijson.items(f, "item")
     except:
         pass
-    return []
 
 def load_insights() -> dict:
     """Load previous insights"""
     try:
         if Path(INSIGHTS_FILE).exists():
-            with open(INSIGHTS_FILE) as f:
-                return json.load(f)
+            return orjson.loads(Path(INSIGHTS_FILE).read_bytes())
     except:
         pass
     return {"history": []}
 
+def _atomic_write(path: str, payload: bytes):
+    """Write-then-rename so a mid-write crash can't corrupt the file"""
+    tmp = path + ".tmp"
+    Path(tmp).write_bytes(payload)
+    os.replace(tmp, path)
+
 def save_insights(insights: dict):
-    """Save insights"""
-    with open(INSIGHTS_FILE, 'w') as f:
-        json.dump(insights, f, indent=2)
+    """Save insights (kept pretty — this file is inspected by humans)"""
+    _atomic_write(INSIGHTS_FILE, orjson.dumps(insights, option=orjson.OPT_INDENT_2))
 
 def save_variants(variants: list):
-    """Save email variants for A/B testing"""
-    with open(VARIANTS_FILE, 'w') as f:
-        json.dump(variants, f, indent=2)
+    """Save email variants for A/B testing (machine-read, compact)"""
+    _atomic_write(VARIANTS_FILE, orjson.dumps(variants))
 
 # ============== ANALYSIS ==============
 
-def calculate_metrics(tracking: dict, events: list) -> dict:
-    """Calculate campaign metrics"""
-    
+def _rates(nums: list, denom: int) -> list:
+    """Percentage rates with a single zero-denominator guard"""
+    if denom <= 0:
+        return [0.0] * len(nums)
+    return [round(n / denom * 100, 1) for n in nums]
+
+def calculate_metrics(tracking: dict, events) -> dict:
+    """Calculate campaign metrics (events may be any iterable)"""
+
     total_sent = len(tracking)
-    
-    # Count events
-    opens = len([e for e in events if e.get("type") == "opened"])
-    clicks = len([e for e in events if e.get("type") == "clicked"])
-    bounces = len([e for e in events if e.get("type") == "bounced"])
-    complaints = len([e for e in events if e.get("type") == "complained"])
-    unsubscribes = len([e for e in events if e.get("type") == "unsubscribed"])
-    
-    # Count follow-up performance
-    followup_1_sent = len([d for d in tracking.values() if d.get("followup_1_sent")])
-    followup_2_sent = len([d for d in tracking.values() if d.get("followup_2_sent")])
-    
-    # Engagement by stage
-    initial_opens = 0
-    followup_1_opens = 0
-    followup_2_opens = 0
-    
+
+    # Count events in a single pass
+    counts = Counter(e.get("type") for e in events)
+    opens = counts["opened"]
+    clicks = counts["clicked"]
+    bounces = counts["bounced"]
+    complaints = counts["complained"]
+    unsubscribes = counts["unsubscribed"]
+
+    # Follow-up performance + engagement by stage, one pass over tracking
+    followup_1_sent = 0
+    followup_2_sent = 0
+    stage_opens = Counter()
+
     for email, data in tracking.items():
+        fu1 = data.get("followup_1_sent")
+        fu2 = data.get("followup_2_sent")
+        if fu1:
+            followup_1_sent += 1
+        if fu2:
+            followup_2_sent += 1
         if data.get("opened"):
-            if not data.get("followup_1_sent"):
-                initial_opens += 1
-            elif not data.get("followup_2_sent"):
-                followup_1_opens += 1
-            else:
-                followup_2_opens += 1
-    
+            # Stage is stamped at send time; derive it for pre-stage rows
+            stage = data.get("current_stage") or ("fu2" if fu2 else "fu1" if fu1 else "initial")
+            stage_opens[stage] += 1
+
+    open_rate, click_rate, bounce_rate, initial_open_rate = _rates(
+        [opens, clicks, bounces, stage_opens["initial"]], total_sent
+    )
+    followup_1_open_rate, = _rates([stage_opens["fu1"]], followup_1_sent)
+    followup_2_open_rate, = _rates([stage_opens["fu2"]], followup_2_sent)
+
     return {
         "total_sent": total_sent,
         "opens": opens,
@@ -107,21 +144,28 @@ def calculate_metrics(tracking: dict, events: list) -> dict:
         "bounces": bounces,
         "complaints": complaints,
         "unsubscribes": unsubscribes,
-        "open_rate": round(opens / total_sent * 100, 1) if total_sent > 0 else 0,
-        "click_rate": round(clicks / total_sent * 100, 1) if total_sent > 0 else 0,
-        "bounce_rate": round(bounces / total_sent * 100, 1) if total_sent > 0 else 0,
+        "open_rate": open_rate,
+        "click_rate": click_rate,
+        "bounce_rate": bounce_rate,
         "followup_1_sent": followup_1_sent,
         "followup_2_sent": followup_2_sent,
-        "initial_open_rate": round(initial_opens / total_sent * 100, 1) if total_sent > 0 else 0,
-        "followup_1_open_rate": round(followup_1_opens / followup_1_sent * 100, 1) if followup_1_sent > 0 else 0,
-        "followup_2_open_rate": round(followup_2_opens / followup_2_sent * 100, 1) if followup_2_sent > 0 else 0,
+        "initial_open_rate": initial_open_rate,
+        "followup_1_open_rate": followup_1_open_rate,
+        "followup_2_open_rate": followup_2_open_rate,
     }
 
 # ============== LLM ANALYSIS ==============
 
-def analyze_with_llm(metrics: dict, previous_insights: dict) -> dict:
+def _history_blob(previous_insights: dict) -> str:
+    """Serialize the last 3 history entries once per run for prompt reuse"""
+    return orjson.dumps(
+        previous_insights.get("history", [])[-3:],
+        option=orjson.OPT_INDENT_2,
+    ).decode()
+
+async def analyze_with_llm(client: httpx.AsyncClient, metrics: dict, history_blob: str) -> dict:
     """Use LLM to analyze performance and suggest improvements"""
-    
+
     prompt = f"""You are an expert cold email strategist analyzing a B2B outreach campaign for Lead Agents Studio (AI agent for medspas).
 
 CURRENT PERFORMANCE:
@@ -134,7 +178,7 @@ CURRENT PERFORMANCE:
 - Follow-up 2 open rate: {metrics['followup_2_open_rate']}%
 
 PREVIOUS INSIGHTS:
-{json.dumps(previous_insights.get('history', [])[-3:], indent=2)}
+{history_blob}
 
 CURRENT COPY APPROACH:
 - Ogilvy-style: problem-first, specific, conversational
@@ -158,12 +202,8 @@ Provide:
 Be specific and data-driven. Format as JSON."""
 
     try:
-        response = requests.post(
-            "https://api.openai.com/v1/chat/completions",
-            headers={
-                "Authorization": f"Bearer {OPENAI_API_KEY}",
-                "Content-Type": "application/json",
-            },
+        response = await client.post(
+            OPENAI_URL,
             json={
                 "model": OPENAI_MODEL,
                 "messages": [
@@ -173,7 +213,6 @@ Be specific and data-driven. Format as JSON."""
                 "temperature": 0.7,
                 "response_format": {"type": "json_object"},
             },
-            timeout=60,
         )
         
         if response.status_code == 200:
@@ -190,7 +229,7 @@ Be specific and data-driven. Format as JSON."""
 
 # ============== VARIANT GENERATION ==============
 
-def generate_variants(insights: dict) -> list:
+async def generate_variants(client: httpx.AsyncClient, insights: dict) -> list:
     """Generate A/B test email variants based on insights"""
     
     if not insights:
@@ -199,7 +238,7 @@ def generate_variants(insights: dict) -> list:
     prompt = f"""Based on these campaign insights, generate 2 A/B test email variants for the INITIAL email (Day 0).
 
 INSIGHTS:
-{json.dumps(insights, indent=2)}
+{orjson.dumps(insights, option=orjson.OPT_INDENT_2).decode()}
 
 CURRENT SUBJECT: "quick question for {{company_name}}"
 
@@ -220,12 +259,8 @@ Return as JSON array:
 Keep {{company_name}}, {{first_name}}, %unsubscribe_url% placeholders."""
 
     try:
-        response = requests.post(
-            "https://api.openai.com/v1/chat/completions",
-            headers={
-                "Authorization": f"Bearer {OPENAI_API_KEY}",
-                "Content-Type": "application/json",
-            },
+        response = await client.post(
+            OPENAI_URL,
             json={
                 "model": OPENAI_MODEL,
                 "messages": [
@@ -235,7 +270,6 @@ Keep {{company_name}}, {{first_name}}, %unsubscribe_url% placeholders."""
                 "temperature": 0.8,
                 "response_format": {"type": "json_object"},
             },
-            timeout=60,
         )
         
         if response.status_code == 200:
@@ -254,14 +288,13 @@ Keep {{company_name}}, {{first_name}}, %unsubscribe_url% placeholders."""
 def run_analysis():
     """Run daily LLM analysis"""
     
-    print(f"\n{'='*60}")
+    print(f"\n{_BAR}")
     print(f"LLM BRAIN - CAMPAIGN ANALYSIS")
     print(f"Time: {datetime.utcnow().isoformat()}")
-    print(f"{'='*60}\n")
+    print(f"{_BAR}\n")
     
     # Load data
     tracking = load_tracking()
-    events = load_events()
     previous_insights = load_insights()
     
     if not tracking:
@@ -271,33 +304,49 @@ def run_analysis():
     print(f"📊 Analyzing {len(tracking)} sent emails...")
     
     # Calculate metrics
-    metrics = calculate_metrics(tracking, events)
+    metrics = calculate_metrics(tracking, iter_events())
     
     print(f"\nCurrent Metrics:")
     print(f"  Open rate: {metrics['open_rate']}%")
     print(f"  Click rate: {metrics['click_rate']}%")
     print(f"  Bounce rate: {metrics['bounce_rate']}%")
-    
-    # LLM Analysis
+
+    # Skip the two LLM round-trips when nothing changed since last run
+    metric_key = hashlib.sha256(json.dumps(metrics, sort_keys=True).encode()).hexdigest()
+    if previous_insights.get("last_metric_key") == metric_key:
+        print("\n⏭️  No material change in metrics — skipping LLM analysis")
+        return
+
+    # LLM Analysis (history serialized once, reused across prompts)
+    history_blob = _history_blob(previous_insights)
+
+    async def _llm_calls():
+        """Both OpenAI calls on one async client; gather-able across campaigns"""
+        async with _openai_client() as client:
+            result = await analyze_with_llm(client, metrics, history_blob)
+            if not result:
+                return {}, []
+            return result, await generate_variants(client, result)
+
     print(f"\n🧠 Running LLM analysis...")
-    insights = analyze_with_llm(metrics, previous_insights)
-    
+    insights, variants = asyncio.run(_llm_calls())
+
     if insights:
         print(f"\n✅ Insights generated:")
         print(json.dumps(insights, indent=2))
-        
+
         # Save insights
         previous_insights["history"].append({
             "timestamp": datetime.utcnow().isoformat(),
             "metrics": metrics,
             "insights": insights,
         })
+        # Cap on-disk history so the file (and its encode cost) stays bounded
+        previous_insights["history"] = previous_insights["history"][-MAX_HISTORY:]
+        previous_insights["last_metric_key"] = metric_key
         save_insights(previous_insights)
-        
-        # Generate A/B test variants
+
         print(f"\n🧪 Generating A/B test variants...")
-        variants = generate_variants(insights)
-        
         if variants:
             print(f"✅ Generated {len(variants)} variants")
             save_variants(variants)
@@ -311,9 +360,9 @@ def run_analysis():
     else:
         print("⚠️  LLM analysis failed")
     
-    print(f"\n{'='*60}")
+    print(f"\n{_BAR}")
     print(f"Analysis complete")
-    print(f"{'='*60}\n")
+    print(f"{_BAR}\n")
 
 if __name__ == "__main__":
     run_analysis()
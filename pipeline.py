@@ -6,25 +6,53 @@ Runs via Render Cron Jobs (or locally)
 Scrapes leads → Enriches → Sends emails
 """
 import os
+import sys
 import json
 import time
-import requests
-from datetime import datetime
+import asyncio
+import logging
+import httpx
+import orjson
+import redis
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from pathlib import Path
 
+# One stderr handler, lazy %-formatting: a record is a single write()
+# and the message string is only built if the level is enabled
+logger = logging.getLogger("pipeline")
+logger.setLevel(logging.INFO)
+if not logger.handlers:
+    _handler = logging.StreamHandler(sys.stderr)
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(_handler)
+
 # ============== CONFIG ==============
 
+# Invariant console banner, built once
+_BAR = "=" * 60
+
 MAILGUN_API_KEY = os.getenv("MAILGUN_API_KEY", "")
 MAILGUN_DOMAIN = os.getenv("MAILGUN_DOMAIN", "leadagentsstudio.com")
 EMAIL_FROM = os.getenv("EMAIL_FROM_ADDRESS", "support@leadagentsstudio.com")
 EMAIL_FROM_NAME = os.getenv("EMAIL_FROM_NAME", "Lead Agents Studio")
 
+# Built once; the send path is then a single client.post with no formatting
+MAILGUN_URL = f"https://api.mailgun.net/v3/{MAILGUN_DOMAIN}/messages"
+MAILGUN_AUTH = ("api", MAILGUN_API_KEY)
+EMAIL_FROM_HEADER = f"{EMAIL_FROM_NAME} <{EMAIL_FROM}>"
+
 BRIGHTDATA_API_KEY = os.getenv("BRIGHTDATA_API_KEY", "")
 SERP_API_KEY = os.getenv("SERP_API_KEY", "")
 
 # Limits
 MAX_EMAILS_PER_RUN = 20
-DELAY_BETWEEN_EMAILS = 60  # seconds
+BATCH_LIMIT = 1000  # Mailgun's recipient-variables cap per message
+
+# How many search queries to scrape per run (concurrently) and the
+# in-flight cap to stay inside BrightData rate limits
+QUERIES_PER_RUN = int(os.getenv("QUERIES_PER_RUN", "1"))
+SCRAPE_CONCURRENCY = 8
 
 # Search queries for Google Maps scraping
 SEARCH_QUERIES = [
@@ -44,29 +72,98 @@ SEARCH_QUERIES = [
     "medspa Las Vegas",
 ]
 
-# Storage (use Redis/DB in production)
+# Hour-of-day -> query lookup for the fallback scheduler, precomputed once
+# so pick time is an index into a tuple (no datetime allocation)
+HOUR_QUERY = tuple(SEARCH_QUERIES[h % len(SEARCH_QUERIES)] for h in range(24))
+
+# Query scheduling: with Redis, a ZSET ranks queries by
+# last_run_ts - YIELD_ALPHA * leads_found, so high-yield queries come up
+# more often than round-robin; without Redis we fall back to hour rotation
+QUERIES_KEY = "queries_priority"
+YIELD_ALPHA = 3600.0  # each lead found buys the query an hour of priority
+
+# Storage: Redis SET when REDIS_URL is configured (shared with the other
+# services, O(1) membership), JSON file fallback for local runs
+REDIS_URL = os.getenv("REDIS_URL", "")
+SENT_KEY = "sent_emails"
+_redis = redis.Redis.from_url(REDIS_URL, decode_responses=True) if REDIS_URL else None
+
 SENT_FILE = "/tmp/sent_emails.json"
 
+# Global Mailgun send budget, shared with realtime_service via Redis.
+# Without Redis each process is effectively unthrottled (single cron run).
+MAX_PER_MINUTE = int(os.getenv("MAILGUN_MAX_PER_MINUTE", "100"))
+RATE_KEY = "mailgun_minute_bucket"
+
+
+def _try_send_tokens(n: int) -> bool:
+    """Charge n emails against the shared per-minute bucket (INCRBY + EXPIRE)"""
+    if not _redis:
+        return True
+    total = _redis.incrby(RATE_KEY, n)
+    if total == n:
+        # Fresh minute: admit the whole chunk even if it exceeds the cap,
+        # otherwise an over-cap batch would starve forever
+        _redis.expire(RATE_KEY, 60)
+        return True
+    if total <= MAX_PER_MINUTE:
+        return True
+    # Over budget: give the tokens back and wait for the minute to roll
+    _redis.decrby(RATE_KEY, n)
+    return False
+
+
+async def acquire_send_tokens(n: int = 1):
+    """Wait until the global Mailgun rate budget admits n more emails"""
+    while not _try_send_tokens(n):
+        await asyncio.sleep(1)
+
 
 # ============== STORAGE ==============
 
 def load_sent_emails() -> set:
     """Load previously sent emails"""
+    if _redis:
+        return set(_redis.smembers(SENT_KEY))
     try:
         if os.path.exists(SENT_FILE):
-            with open(SENT_FILE, 'r') as f:
-                return set(json.load(f))
+            return set(orjson.loads(Path(SENT_FILE).read_bytes()))
     except:
         pass
     return set()
 
 
+def sent_count() -> int:
+    """How many emails have been sent all-time"""
+    if _redis:
+        return _redis.scard(SENT_KEY)
+    return len(load_sent_emails())
+
+
+def filter_new_leads(leads: list) -> list:
+    """Drop already-contacted leads in one dedup round trip (SMISMEMBER)"""
+    if not leads:
+        return []
+    emails = [l.get("email", "") for l in leads]
+    if _redis:
+        flags = _redis.smismember(SENT_KEY, emails)
+        return [l for l, f in zip(leads, flags) if not f]
+    sent = load_sent_emails()
+    return [l for l, e in zip(leads, emails) if e not in sent]
+
+
 def save_sent_email(email: str):
     """Save sent email"""
+    if _redis:
+        _redis.sadd(SENT_KEY, email.lower())
+        return
     sent = load_sent_emails()
     sent.add(email.lower())
-    with open(SENT_FILE, 'w') as f:
-        json.dump(list(sent), f)
+    # Write-then-rename: a kill mid-write can't truncate the sent-set
+    # (which would re-send the whole history next run)
+    tmp = SENT_FILE + ".tmp"
+    Path(tmp).write_bytes(orjson.dumps(list(sent)))
+    os.replace(tmp, SENT_FILE)
 
 
 # ============== EMAIL TEMPLATE ==============
@@ -98,58 +195,129 @@ support@leadagentsstudio.com
 
 Unsubscribe: %unsubscribe_url%"""
 
+# Batch form of the template, formatted once at import; Mailgun fills the
+# %recipient.*% placeholders server-side, so per-email Python cost is zero
+BATCH_SUBJECT = "quick question for %recipient.company_name%"
+BATCH_BODY = EMAIL_TEMPLATE.format(
+    first_name="%recipient.first_name%",
+    company_name="%recipient.company_name%",
+)
+
+
+# ============== HTTP ==============
+
+RETRY_TOTAL = 5
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+async def post_with_retry(client: httpx.AsyncClient, url: str, **kwargs) -> httpx.Response:
+    """POST with exponential backoff on transient errors, honoring Retry-After"""
+    for attempt in range(RETRY_TOTAL):
+        try:
+            response = await client.post(url, **kwargs)
+        except httpx.TransportError:
+            if attempt == RETRY_TOTAL - 1:
+                raise
+            await asyncio.sleep(0.5 * 2 ** attempt)
+            continue
+        if response.status_code not in RETRY_STATUSES or attempt == RETRY_TOTAL - 1:
+            return response
+        await asyncio.sleep(_retry_delay(response.headers.get("Retry-After"), attempt))
+    return response
+
+
+def _retry_delay(retry_after, attempt: int) -> float:
+    """Backoff delay, honoring Retry-After in both its seconds and date forms"""
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+        try:
+            until = parsedate_to_datetime(retry_after)
+            return max(0.0, (until - datetime.now(timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            pass
+    return 0.5 * 2 ** attempt
+
+
+# ============== QUERY SCHEDULING ==============
+
+def pick_queries(n: int) -> list:
+    """Next n queries: best-scored from the Redis ZSET, hour rotation fallback"""
+    if _redis:
+        if not _redis.exists(QUERIES_KEY):
+            _redis.zadd(QUERIES_KEY, {q: 0 for q in SEARCH_QUERIES})
+        picked = [q for q, _score in _redis.zpopmin(QUERIES_KEY, n)]
+        if picked:
+            return picked
+    idx = time.gmtime().tm_hour
+    return [HOUR_QUERY[(idx + i) % 24] for i in range(n)]
+
+
+def record_query_yield(query: str, found: int):
+    """Re-rank a popped query: recent runs push it back, leads pull it forward"""
+    if _redis:
+        _redis.zadd(QUERIES_KEY, {query: time.time() - YIELD_ALPHA * found})
+
 
 # ============== SCRAPING ==============
 
-def scrape_google_maps_brightdata(query: str) -> list:
+async def scrape_google_maps_brightdata(client: httpx.AsyncClient, query: str) -> list:
     """Scrape Google Maps using BrightData SERP API"""
-    
+
     if not BRIGHTDATA_API_KEY:
-        print("   ⚠️ No BrightData API key configured")
+        logger.warning("   ⚠️ No BrightData API key configured")
         return []
-    
+
     # BrightData SERP API for Google Maps
     url = "https://api.brightdata.com/serp/google/maps"
-    
+
     headers = {
         "Authorization": f"Bearer {BRIGHTDATA_API_KEY}",
         "Content-Type": "application/json",
     }
-    
+
     payload = {
         "query": query,
         "country": "us",
         "language": "en",
     }
-    
+
     try:
-        response = requests.post(url, headers=headers, json=payload, timeout=60)
-        
+        response = await post_with_retry(client, url, headers=headers, json=payload, timeout=60)
+
         if response.status_code == 200:
-            data = response.json()
+            # orjson parses the multi-MB SERP payload ~3x faster than
+            # the stdlib parser behind response.json()
+            data = orjson.loads(response.content)
             results = data.get("organic", [])
             
             leads = []
             for r in results:
-                if r.get("email"):
-                    leads.append({
-                        "email": r["email"],
-                        "company_name": r.get("title", ""),
-                        "first_name": "there",  # Need enrichment for actual name
-                        "city": r.get("city", ""),
-                        "phone": r.get("phone", ""),
-                        "website": r.get("website", ""),
-                        "rating": r.get("rating"),
-                        "reviews": r.get("reviews_count"),
-                    })
-            
+                # Canonicalize once at source; downstream dedup reuses
+                # this key as-is. No rating usually means a stub listing.
+                email = (r.get("email") or "").strip().lower()
+                if not email or r.get("rating") is None:
+                    continue
+                leads.append({
+                    "email": email,
+                    "company_name": r.get("title", ""),
+                    "first_name": "there",  # Need enrichment for actual name
+                    "city": r.get("city", ""),
+                    "phone": r.get("phone", ""),
+                    "website": r.get("website", ""),
+                    "rating": r.get("rating"),
+                    "reviews": r.get("reviews_count"),
+                })
+
             return leads
         else:
-            print(f"   API Error: {response.status_code}")
+            logger.warning("   API Error: %s", response.status_code)
             return []
-            
+
     except Exception as e:
-        print(f"   Exception: {e}")
+        logger.warning("   Exception: %s", e)
         return []
 
 
@@ -163,30 +331,27 @@ def get_sample_leads() -> list:
 
 # ============== SENDING ==============
 
-def send_email(to_email: str, subject: str, body: str) -> dict:
-    """Send email via Mailgun"""
-    
+async def send_batch(client: httpx.AsyncClient, recipients: dict, subject: str, body: str) -> dict:
+    """Send one Mailgun message to up to 1000 recipients via recipient-variables"""
+
     if not MAILGUN_API_KEY:
-        print("   ⚠️ No Mailgun API key configured")
+        logger.warning("   ⚠️ No Mailgun API key configured")
         return {"success": False, "error": "No API key"}
-    
+
     data = {
-        "from": f"{EMAIL_FROM_NAME} <{EMAIL_FROM}>",
-        "to": to_email,
+        "from": EMAIL_FROM_HEADER,
+        "to": list(recipients),
         "subject": subject,
         "text": body,
+        "recipient-variables": json.dumps(recipients),
         "o:tracking": "yes",
         "o:tracking-clicks": "yes",
         "o:tracking-opens": "yes",
         "o:tag": ["lead-agents-studio", "medspa", "pipeline"],
     }
-    
-    response = requests.post(
-        f"https://api.mailgun.net/v3/{MAILGUN_DOMAIN}/messages",
-        auth=("api", MAILGUN_API_KEY),
-        data=data,
-    )
-    
+
+    response = await post_with_retry(client, MAILGUN_URL, auth=MAILGUN_AUTH, data=data)
+
     return {
         "success": response.status_code == 200,
         "status_code": response.status_code,
@@ -197,86 +362,94 @@ def send_email(to_email: str, subject: str, body: str) -> dict:
 
 # ============== MAIN ==============
 
-def run_pipeline():
+async def run_pipeline():
     """Main pipeline execution"""
     
-    print(f"\n{'='*60}")
-    print(f"LEAD AGENTS STUDIO - PIPELINE")
-    print(f"Time: {datetime.utcnow().isoformat()}")
-    print(f"{'='*60}\n")
-    
-    # Load sent emails
-    sent_emails = load_sent_emails()
-    print(f"📧 Previously sent: {len(sent_emails)} emails")
-    
-    # Select query based on time
-    query_idx = datetime.utcnow().hour % len(SEARCH_QUERIES)
-    query = SEARCH_QUERIES[query_idx]
-    
-    print(f"\n🔍 Scraping: {query}")
-    
-    # Scrape leads
-    leads = scrape_google_maps_brightdata(query)
-    
-    if not leads:
-        print("   No leads found from scraping, using samples...")
-        leads = get_sample_leads()
-    
-    print(f"   Found: {len(leads)} leads")
-    
-    # Filter already sent
-    new_leads = [l for l in leads if l.get("email", "").lower() not in sent_emails]
-    print(f"   New leads: {len(new_leads)}")
-    
-    # Limit per run
-    to_send = new_leads[:MAX_EMAILS_PER_RUN]
-    print(f"   Will send: {len(to_send)}")
+    logger.info("\n%s\nLEAD AGENTS STUDIO - PIPELINE\nTime: %s\n%s\n", _BAR, datetime.utcnow().isoformat(), _BAR)
+
+    # Count of previously sent emails
+    previously_sent = sent_count()
+    logger.info("📧 Previously sent: %s emails", previously_sent)
     
-    # Send emails
+    # Highest-priority queries for this tick
+    queries = pick_queries(QUERIES_PER_RUN)
+
     sent = 0
     failed = 0
-    
-    for i, lead in enumerate(to_send):
-        email = lead.get("email", "")
-        company = lead.get("company_name", "your clinic")
-        first_name = lead.get("first_name", "there")
-        
-        print(f"\n[{i+1}/{len(to_send)}] {email}")
-        print(f"    Company: {company}")
-        
-        subject = f"quick question for {company}"
-        body = EMAIL_TEMPLATE.format(
-            first_name=first_name,
-            company_name=company,
-        )
-        
-        result = send_email(email, subject, body)
-        
-        if result["success"]:
-            print(f"    ✅ Sent!")
-            save_sent_email(email)
-            sent += 1
-        else:
-            print(f"    ❌ Failed: {result.get('error', 'Unknown error')}")
-            failed += 1
-        
-        # Rate limiting
-        if i < len(to_send) - 1:
-            print(f"    ⏳ Waiting {DELAY_BETWEEN_EMAILS}s...")
-            time.sleep(DELAY_BETWEEN_EMAILS)
-    
+
+    # One client for the whole run: scrape + send share the connection pool
+    async with httpx.AsyncClient(timeout=60) as client:
+        logger.info("\n🔍 Scraping %s queries: %s", len(queries), ", ".join(queries))
+
+        # Scrape all queries in parallel, bounded so we stay inside
+        # BrightData rate limits
+        sem = asyncio.Semaphore(SCRAPE_CONCURRENCY)
+
+        async def _scrape(q):
+            async with sem:
+                return await scrape_google_maps_brightdata(client, q)
+
+        results = await asyncio.gather(*(_scrape(q) for q in queries))
+
+        # Feed each query's yield back into the scheduler
+        for q, chunk in zip(queries, results):
+            record_query_yield(q, len(chunk))
+
+        # Collapse within-run duplicates (the same clinic can show up in
+        # several queries) before any sent-set lookups
+        leads = list({
+            lead["email"]: lead
+            for chunk in results
+            for lead in chunk
+            if lead.get("email")
+        }.values())
+
+        if not leads:
+            logger.info("   No leads found from scraping, using samples...")
+            leads = get_sample_leads()
+
+        logger.info("   Found: %s leads", len(leads))
+
+        # Filter already sent (one dedup round trip)
+        new_leads = filter_new_leads(leads)
+        logger.info("   New leads: %s", len(new_leads))
+
+        # Limit per run
+        to_send = new_leads[:MAX_EMAILS_PER_RUN]
+        logger.info("   Will send: %s", len(to_send))
+
+        # One Mailgun round-trip per 1000 recipients
+        for i in range(0, len(to_send), BATCH_LIMIT):
+            chunk = to_send[i:i + BATCH_LIMIT]
+            recipients = {
+                lead["email"]: {
+                    "first_name": lead.get("first_name", "there"),
+                    "company_name": lead.get("company_name", "your clinic"),
+                }
+                for lead in chunk
+            }
+
+            logger.info("\n📤 Batch %s: %s recipients", i // BATCH_LIMIT + 1, len(recipients))
+
+            await acquire_send_tokens(len(recipients))
+            result = await send_batch(client, recipients, BATCH_SUBJECT, BATCH_BODY)
+
+            if result["success"]:
+                logger.info("    ✅ Sent!")
+                for email in recipients:
+                    save_sent_email(email)
+                sent += len(recipients)
+            else:
+                logger.warning("    ❌ Failed: %s", result.get("error", "Unknown error"))
+                failed += len(recipients)
+
     # Summary
-    print(f"\n{'='*60}")
-    print(f"SUMMARY")
-    print(f"{'='*60}")
-    print(f"Query: {query}")
-    print(f"Leads found: {len(leads)}")
-    print(f"New leads: {len(new_leads)}")
-    print(f"Sent: {sent}")
-    print(f"Failed: {failed}")
-    print(f"Total sent (all time): {len(sent_emails) + sent}")
-    print(f"{'='*60}\n")
+    logger.info(
+        "\n%s\nSUMMARY\n%s\nQueries: %s\nLeads found: %s\nNew leads: %s\nSent: %s\nFailed: %s\nTotal sent (all time): %s\n%s\n",
+        _BAR, _BAR, ", ".join(queries), len(leads), len(new_leads),
+        sent, failed, previously_sent + sent, _BAR,
+    )
 
 
 if __name__ == "__main__":
-    run_pipeline()
+    asyncio.run(run_pipeline())
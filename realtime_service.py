@@ -5,16 +5,30 @@ Listens for BrightData webhooks 24/7 and sends emails instantly
 """
 import os
 import json
+import time
+import asyncio
 import hmac
 import hashlib
+import orjson
+import redis
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
-from fastapi import FastAPI, Request, BackgroundTasks
+from fastapi import FastAPI, Request, BackgroundTasks, Response
 from pydantic import BaseModel
 
 app = FastAPI(title="Lead Agents Studio - Real-Time", version="1.0")
 
+@app.on_event("startup")
+async def _configure_executor():
+    # Sized so concurrent webhook sends don't queue behind each other in
+    # the default 5-thread pool; serves all asyncio.to_thread calls
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=16))
+
 # ============== CONFIG ==============
 
 MAILGUN_API_KEY = os.getenv("MAILGUN_API_KEY", "")
@@ -22,46 +36,132 @@ MAILGUN_DOMAIN = os.getenv("MAILGUN_DOMAIN", "leadagentsstudio.com")
 FROM_EMAIL = os.getenv("EMAIL_FROM_ADDRESS", "support@leadagentsstudio.com")
 FROM_NAME = os.getenv("EMAIL_FROM_NAME", "Lead Agents Studio")
 
+# Built once; the send path is then a single SESSION.post with no formatting
+MAILGUN_URL = f"https://api.mailgun.net/v3/{MAILGUN_DOMAIN}/messages"
+MAILGUN_AUTH = ("api", MAILGUN_API_KEY)
+FROM_HEADER = f"{FROM_NAME} <{FROM_EMAIL}>"
+
 BRIGHTDATA_WEBHOOK_SECRET = os.getenv("BRIGHTDATA_WEBHOOK_SECRET", "")
 
-# Storage
+# Storage: Redis SET when REDIS_URL is configured (shared with the pipeline,
+# O(1) membership), JSON file fallback for local runs
+REDIS_URL = os.getenv("REDIS_URL", "")
+SENT_KEY = "sent_emails"
+_redis = redis.Redis.from_url(REDIS_URL, decode_responses=True) if REDIS_URL else None
+
 SENT_FILE = "/tmp/sent_las.json"
-SIGNALS_FILE = "/tmp/signals_las.json"
+SIGNALS_FILE = "/tmp/signals_las.jsonl"
+SIGNALS_KEY = "signals"
+
+# Keep last 1000 signals
+MAX_SIGNALS = 1000
+
+# Global Mailgun send budget shared with pipeline.py via the same Redis
+# bucket; without Redis the webhook volume is low enough to send freely
+MAX_PER_MINUTE = int(os.getenv("MAILGUN_MAX_PER_MINUTE", "100"))
+RATE_KEY = "mailgun_minute_bucket"
+
+# Rotate the fallback signal log once it grows past this size
+SIGNALS_ROTATE_BYTES = 1_000_000
+
+# One pooled HTTPS session reused across all webhook sends; transient
+# 429/5xx responses are retried with backoff inside urllib3 so a flaky
+# minute doesn't permanently drop a lead
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=32,
+    max_retries=Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods={"POST"},
+        respect_retry_after_header=True,
+    ),
+))
 
 # ============== STORAGE ==============
 
 def load_sent() -> set:
+    if _redis:
+        return set(_redis.smembers(SENT_KEY))
     try:
         if Path(SENT_FILE).exists():
-            return set(json.loads(Path(SENT_FILE).read_text()))
+            return set(orjson.loads(Path(SENT_FILE).read_bytes()))
     except:
         pass
     return set()
 
+def is_sent(email: str) -> bool:
+    """O(1) dedup check (SISMEMBER, or the file-backed set locally)"""
+    if _redis:
+        return bool(_redis.sismember(SENT_KEY, email.lower()))
+    return email.lower() in load_sent()
+
 def save_sent(email: str):
+    if _redis:
+        _redis.sadd(SENT_KEY, email.lower())
+        return
     sent = load_sent()
     sent.add(email.lower())
-    Path(SENT_FILE).write_text(json.dumps(list(sent)))
+    # Write-then-rename: a kill mid-write can't truncate the sent-set
+    tmp = SENT_FILE + ".tmp"
+    Path(tmp).write_bytes(orjson.dumps(list(sent)))
+    os.replace(tmp, SENT_FILE)
 
 def log_signal(signal: dict):
-    """Log incoming signal"""
-    signals = []
+    """Log incoming signal — O(1) append, never a full-history rewrite"""
+    entry = orjson.dumps({
+        "timestamp": datetime.utcnow().isoformat(),
+        "signal": signal,
+    })
+
+    if _redis:
+        with _redis.pipeline(transaction=False) as pipe:
+            pipe.lpush(SIGNALS_KEY, entry)
+            pipe.ltrim(SIGNALS_KEY, 0, MAX_SIGNALS - 1)
+            pipe.execute()
+        return
+
+    with open(SIGNALS_FILE, 'ab') as f:
+        f.write(entry + b"\n")
+    _rotate_signals()
+
+def _rotate_signals():
+    """Trim the fallback JSONL log to its tail once it gets large"""
+    try:
+        if Path(SIGNALS_FILE).stat().st_size > SIGNALS_ROTATE_BYTES:
+            with open(SIGNALS_FILE) as f:
+                tail = deque(f, maxlen=MAX_SIGNALS)
+            tmp = SIGNALS_FILE + ".tmp"
+            with open(tmp, 'w') as f:
+                f.writelines(tail)
+            os.replace(tmp, SIGNALS_FILE)
+    except:
+        pass
+
+def recent_signals(limit: int = MAX_SIGNALS) -> list:
+    """Last `limit` signals in chronological order (tail read only)"""
+    if _redis:
+        return [orjson.loads(s) for s in reversed(_redis.lrange(SIGNALS_KEY, 0, limit - 1))]
     try:
         if Path(SIGNALS_FILE).exists():
-            signals = json.loads(Path(SIGNALS_FILE).read_text())
+            with open(SIGNALS_FILE, 'rb') as f:
+                return [orjson.loads(line) for line in deque(f, maxlen=limit)]
     except:
         pass
-    
-    signals.append({
-        "timestamp": datetime.utcnow().isoformat(),
-        "signal": signal,
-    })
-    
-    # Keep last 1000 signals
-    if len(signals) > 1000:
-        signals = signals[-1000:]
-    
-    Path(SIGNALS_FILE).write_text(json.dumps(signals, indent=2))
+    return []
+
+def signal_count() -> int:
+    if _redis:
+        return _redis.llen(SIGNALS_KEY)
+    try:
+        if Path(SIGNALS_FILE).exists():
+            with open(SIGNALS_FILE) as f:
+                return sum(1 for _ in f)
+    except:
+        pass
+    return 0
 
 # ============== EMAIL SENDING ==============
 
@@ -92,18 +192,31 @@ support@leadagentsstudio.com
 
 Unsubscribe: %unsubscribe_url%"""
 
+def acquire_send_token():
+    """Block until the shared per-minute Mailgun bucket grants a token"""
+    while _redis:
+        n = _redis.incr(RATE_KEY)
+        if n == 1:
+            _redis.expire(RATE_KEY, 60)
+        if n <= MAX_PER_MINUTE:
+            return
+        time.sleep(1)
+
 def send_email(email: str, company: str) -> bool:
     """Send email via Mailgun"""
-    
+
+    acquire_send_token()
+
     subject = f"quick question for {company}"
-    body = EMAIL_TEMPLATE.format(company_name=company)
+    # Single placeholder: str.replace skips the format mini-language parser
+    body = EMAIL_TEMPLATE.replace("{company_name}", company)
     
     try:
-        response = requests.post(
-            f"https://api.mailgun.net/v3/{MAILGUN_DOMAIN}/messages",
-            auth=("api", MAILGUN_API_KEY),
+        response = SESSION.post(
+            MAILGUN_URL,
+            auth=MAILGUN_AUTH,
             data={
-                "from": f"{FROM_NAME} <{FROM_EMAIL}>",
+                "from": FROM_HEADER,
                 "to": email,
                 "subject": subject,
                 "text": body,
@@ -122,9 +235,13 @@ def send_email(email: str, company: str) -> bool:
 
 # ============== SIGNAL PROCESSING ==============
 
-def process_signal(signal_data: dict) -> dict:
-    """Process incoming signal and send email if qualified"""
-    
+async def process_signal(signal_data: dict) -> dict:
+    """Process incoming signal and send email if qualified
+
+    Blocking Mailgun/storage I/O runs in the thread pool so concurrent
+    webhooks overlap instead of serializing on the event loop.
+    """
+
     # Extract business info from signal
     business_name = signal_data.get("name", signal_data.get("title", ""))
     email = signal_data.get("email", "")
@@ -139,8 +256,7 @@ def process_signal(signal_data: dict) -> dict:
         return {"status": "skipped", "reason": "no_email"}
     
     # Check if already sent
-    sent = load_sent()
-    if email.lower() in sent:
+    if await asyncio.to_thread(is_sent, email):
         return {"status": "skipped", "reason": "already_sent"}
     
     # Simple qualification (in production: use scoring service)
@@ -149,8 +265,8 @@ def process_signal(signal_data: dict) -> dict:
     # Send email
     company = business_name if business_name else "your clinic"
     
-    if send_email(email, company):
-        save_sent(email)
+    if await asyncio.to_thread(send_email, email, company):
+        await asyncio.to_thread(save_sent, email)
         return {
             "status": "sent",
             "email": email,
@@ -181,28 +297,32 @@ async def brightdata_webhook(request: Request, background_tasks: BackgroundTasks
     Process and send email in real-time
     """
     
-    try:
-        data = await request.json()
-    except:
-        data = await request.form()
-        data = dict(data)
-    
-    # Verify webhook signature (if secret configured)
+    # Verify over the raw bytes (re-serialized JSON wouldn't match) in
+    # constant time before trusting the payload
+    body = await request.body()
+
     if BRIGHTDATA_WEBHOOK_SECRET:
         signature = request.headers.get("X-BrightData-Signature", "")
-        # Add signature verification here
-        pass
-    
-    # Log signal
-    log_signal(data)
-    
+        expected = hmac.new(BRIGHTDATA_WEBHOOK_SECRET.encode(), body, hashlib.sha256).hexdigest()
+        if not hmac.compare_digest(expected, signature):
+            return Response(status_code=401)
+
+    try:
+        data = json.loads(body)
+    except:
+        data = dict(await request.form())
+
+    # Log signal off the event loop — file/Redis I/O must not stall
+    # concurrent webhooks or delay the ack
+    await asyncio.to_thread(log_signal, data)
+
     # Process in background
-    def process():
-        result = process_signal(data)
+    async def process():
+        result = await process_signal(data)
         print(f"Signal processed: {result}")
-    
+
     background_tasks.add_task(process)
-    
+
     return {"status": "received"}
 
 @app.post("/api/test-signal")
@@ -216,8 +336,8 @@ async def test_signal(background_tasks: BackgroundTasks):
         "source": "test",
     }
     
-    def process():
-        result = process_signal(test_data)
+    async def process():
+        result = await process_signal(test_data)
         print(f"Test signal: {result}")
     
     background_tasks.add_task(process)
@@ -227,31 +347,16 @@ async def test_signal(background_tasks: BackgroundTasks):
 @app.get("/api/stats")
 def stats():
     """Get stats"""
-    sent = load_sent()
-    
-    signals = []
-    try:
-        if Path(SIGNALS_FILE).exists():
-            signals = json.loads(Path(SIGNALS_FILE).read_text())
-    except:
-        pass
-    
     return {
-        "total_sent": len(sent),
-        "signals_received": len(signals),
+        "total_sent": len(load_sent()),
+        "signals_received": signal_count(),
         "status": "listening",
     }
 
 @app.get("/api/signals")
 def get_signals(limit: int = 50):
     """Get recent signals"""
-    try:
-        if Path(SIGNALS_FILE).exists():
-            signals = json.loads(Path(SIGNALS_FILE).read_text())
-            return {"signals": signals[-limit:]}
-    except:
-        pass
-    return {"signals": []}
+    return {"signals": recent_signals(limit)}
 
 @app.get("/api/sent")
 def get_sent():
@@ -1,10 +1,13 @@
 """Lead Agents Studio - Simple API"""
 import os
-import json
+import orjson
 from datetime import datetime
 from pathlib import Path
 from fastapi import FastAPI, BackgroundTasks
-import subprocess
+
+from pipeline import run_pipeline as pipeline_run
+from followup_system import send_followups
+from llm_brain import run_analysis
 
 app = FastAPI()
 
@@ -13,7 +16,7 @@ SENT_FILE = "/tmp/sent_las.json"
 def load_sent():
     try:
         if Path(SENT_FILE).exists():
-            return set(json.loads(Path(SENT_FILE).read_text()))
+            return set(orjson.loads(Path(SENT_FILE).read_bytes()))
     except:
         pass
     return set()
@@ -40,31 +43,24 @@ def stats():
 @app.post("/api/pipeline/run")
 def run_pipeline(background_tasks: BackgroundTasks):
     """Trigger pipeline"""
-    
-    def run():
-        subprocess.run(["python3", "pipeline.py"], capture_output=True)
-    
-    background_tasks.add_task(run)
+
+    # Async coroutine; runs on the app's event loop — no interpreter spawn
+    background_tasks.add_task(pipeline_run)
     return {"status": "triggered"}
 
 @app.post("/api/followup/run")
 def run_followup(background_tasks: BackgroundTasks):
     """Trigger follow-up system"""
-    
-    def run():
-        subprocess.run(["python3", "followup_system.py"], capture_output=True)
-    
-    background_tasks.add_task(run)
+
+    # Sync; FastAPI runs it in the threadpool
+    background_tasks.add_task(send_followups)
     return {"status": "triggered"}
 
 @app.post("/api/brain/analyze")
 def run_brain_analysis(background_tasks: BackgroundTasks):
     """Trigger LLM brain analysis"""
-    
-    def run():
-        subprocess.run(["python3", "llm_brain.py"], capture_output=True)
-    
-    background_tasks.add_task(run)
+
+    background_tasks.add_task(run_analysis)
     return {"status": "triggered"}
 
 @app.get("/api/insights")
@@ -72,9 +68,8 @@ def get_insights():
     """Get latest LLM insights"""
     try:
         if Path("/tmp/llm_insights.json").exists():
-            with open("/tmp/llm_insights.json") as f:
-                data = json.load(f)
-                return data.get("history", [])[-1] if data.get("history") else {}
+            data = orjson.loads(Path("/tmp/llm_insights.json").read_bytes())
+            return data.get("history", [])[-1] if data.get("history") else {}
     except:
         pass
     return {}
@@ -84,8 +79,7 @@ def get_variants():
     """Get A/B test variants"""
     try:
         if Path("/tmp/email_variants.json").exists():
-            with open("/tmp/email_variants.json") as f:
-                return {"variants": json.load(f)}
+            return {"variants": orjson.loads(Path("/tmp/email_variants.json").read_bytes())}
     except:
         pass
     return {"variants": []}